@@ -1,8 +1,10 @@
+import os
 import numpy as np
 import SDFC as sd
 import xarray as xr
 import matplotlib.pyplot as plt
 import texttable as tt
+from gev_functions import bootstrap_seeds, map_blocks, empirical_ranks, return_level_kernel, _time_last
 
 import warnings
 warnings.filterwarnings('ignore')
@@ -15,24 +17,17 @@ def return_period_obs(da,periods_per_year,threshold=None):
     - periods_per_year: number of timesteps per year
     - threshold: optional: only returns only events above a given return level
     '''
-    if not isinstance(da,np.ndarray):
-        da_values_sorted = np.sort(da.values.flatten())
-    else:
-        da_values_sorted = np.sort(da.flatten())
-    # total number of points
-    N = da_values_sorted.size
-    # observations exceeding threshold
-    if threshold is not None:
-        da_values_sorted = da_values_sorted[np.where(da_values_sorted>threshold)]
+    # observations exceeding threshold, sorted; missing values are dropped
+    levels, ranks, N = empirical_ranks(np.asarray(da).ravel(),threshold=threshold,ties='ordinal')
     # fraction of observations exceeding threshold
-    k = da_values_sorted.size
+    k = levels.size
     zeta_u = k/N
 
     # Exceedance probabilities for the observations (>threshold)
-    prob_exceed = (k - np.arange(1,k+1) + 1) / (k + 1)
+    prob_exceed = ranks / (k + 1)
     # Calculate return periods in years from exceedance probabilities and timestepping
     periods = 1 / (prob_exceed * periods_per_year * zeta_u )
-    out = xr.DataArray(dims=['return period'],coords={'return period':periods},data=da_values_sorted,name='return level')
+    out = xr.DataArray(dims=['return period'],coords={'return period':periods},data=levels,name='return level')
     out['return period'].attrs['units'] = 'year'
     return out
 
@@ -86,13 +81,53 @@ def print_law( law ):
         tab.add_row( row )
     print(tab.draw() + "\n")
 
-def fit_return_levels_sdfc(da,times,periods_per_year,kind,N_boot=None,full=False,model=False,method='mle',**kwargs):
+def _bootstrap_sdfc_block(kind,method,Y,size,seed,kwargs):
+    '''
+    SDFC fits of `size` resamples of Y (and of its covariates c_*) drawn with seed,
+    array (size, number of coefficients)
+    '''
+    rng = np.random.default_rng(seed)
+    law_class = sd.GPD if kind.upper() == 'GPD' else sd.GEV
+    coefs = []
+    for i in range(size):
+        idx = rng.integers(0,Y.size,size=Y.size)
+        kwargs_i = {key: value[idx] if 'c_' in key else value for key,value in kwargs.items()}
+        law = law_class(method = method.lower())
+        law.fit(Y[idx],**kwargs_i)
+        coefs.append(law.coef_)
+    return np.array(coefs)
+
+def bootstrap_sdfc(Y,kind,N_boot,method='mle',rng=None,n_jobs=1,executor=None,block_size=100,**kwargs):
+    '''
+    Bootstrap SDFC fits of Y, as law.info_.coefs_bs_ of fit_bootstrap, but with
+    reproducible random streams per block of block_size replicates (see
+    gev_functions.bootstrap_seeds) spread over n_jobs processes or an executor.
+    The result for a given rng does not depend on the number of workers.
+    '''
+    blocks = [(kind,method,Y,size,seed,kwargs) for size,seed in bootstrap_seeds(rng,N_boot,block_size)]
+    return np.concatenate(map_blocks(_bootstrap_sdfc_block,blocks,n_jobs,executor))
+
+def _law_parameters(law,names,coefs,kwargs):
+    '''
+    Parameters names of a fitted SDFC law: the columns of coefs (coef_, or the
+    bootstrap coefs_bs) in order for the fitted ones, kwargs['f_<name>'] for the
+    fixed ones. Returns the values and whether each was fitted.
+    '''
+    fitted = [not law._lhs.is_fixed(name) for name in names]
+    columns = iter(np.moveaxis(np.asarray(coefs,dtype=float),-1,0))
+    values = [next(columns) if free else kwargs['f_' + name] for name,free in zip(names,fitted)]
+    return values, fitted
+
+def fit_return_levels_sdfc(da,times,periods_per_year,kind,N_boot=None,full=False,model=False,method='mle',
+                           rng=None,n_jobs=1,executor=None,**kwargs):
     '''
     Fit data to GPD or GEV and return results
     Inputs:
         - da: 1D DataArray of numpy array, timeseries
         - threshold: threshold for GPD
         - times: return times in years for which to compute return levels, 1D Array
+        - rng, n_jobs, executor: if any is given, the N_boot replicates are run with
+          bootstrap_sdfc (seeded, parallel) instead of SDFC's fit_bootstrap
 
     2013/10/13: drop NaNs from array before computing
     '''
@@ -117,11 +152,16 @@ def fit_return_levels_sdfc(da,times,periods_per_year,kind,N_boot=None,full=False
         Y = da[~np.isnan(da)]
 
     # Fitting using SDFC
+    own_bootstrap = rng is not None or n_jobs != 1 or executor is not None
     if kind.upper() == 'GPD':
         threshold = kwargs['f_loc']
         law_gpd = sd.GPD(method = method.lower())
-        if N_boot:
+        if N_boot and own_bootstrap:
+            law_gpd.fit(Y,**kwargs)
+            coefs_bs = bootstrap_sdfc(Y,kind,N_boot,method,rng,n_jobs,executor,**kwargs)
+        elif N_boot:
             law_gpd.fit_bootstrap(Y,n_bootstrap=N_boot,alpha=0.05,**kwargs)
+            coefs_bs = law_gpd.info_.coefs_bs_
         else:
             law_gpd.fit_bootstrap(Y,**kwargs)
         # law_gpd.fit(Y, **kwargs)
@@ -130,18 +170,15 @@ def fit_return_levels_sdfc(da,times,periods_per_year,kind,N_boot=None,full=False
         # According to Coles 2001, Eq. 4.13 ff - sign for xi NOT reversed, SDFC has same convention as Coles
         # if law_gpd.n_bootstrap == 0:
         if not N_boot:
-            return_levels = threshold + law_gpd.coef_[0] /  law_gpd.coef_[1]  * (( times[:,None] * periods_per_year * zeta_u )**law_gpd.coef_[1] - 1)
+            scale, shape = _law_parameters(law_gpd,('scale','shape'),law_gpd.coef_,kwargs)[0]
+            return_levels = return_level_kernel(times,threshold,scale,shape,'GPD',periods_per_year,zeta_u)
 
-            out = xr.DataArray(dims=['return period'],coords={'return period':times},data=np.squeeze(return_levels),name='return level')
+            out = xr.DataArray(dims=['return period'],coords={'return period':times},data=return_levels,name='return level')
         else:
-            if not law_gpd._lhs.is_fixed('scale') and not law_gpd._lhs.is_fixed('shape'): # fit both scale and shape
-                return_levels = threshold + law_gpd.info_.coefs_bs_[:,0] /  law_gpd.info_.coefs_bs_[:,1]  * (( times[:,None] * periods_per_year * zeta_u )**law_gpd.info_.coefs_bs_[:,1] - 1)
-            elif not law_gpd._lhs.is_fixed('scale') and law_gpd._lhs.is_fixed('shape'): # fit only scale, shape is fixed
-                return_levels = threshold + law_gpd.info_.coefs_bs_[:,0] /  kwargs['f_shape']  * (( times[:,None] * periods_per_year * zeta_u )**kwargs['f_shape'] - 1)
-            elif law_gpd._lhs.is_fixed('scale') and not law_gpd._lhs.is_fixed('shape'): # scale is fixed, fit only shape
-                return_levels = threshold + kwargs['f_scale'] /  law_gpd.info_.coefs_bs_[:,0]  * (( times[:,None] * periods_per_year * zeta_u )**law_gpd.info_.coefs_bs_[:,0] - 1)
-
-            N = np.arange(law_gpd.info_.n_bootstrap)
+            scale, shape = _law_parameters(law_gpd,('scale','shape'),coefs_bs,kwargs)[0]
+            return_levels = return_level_kernel(times[:,None],threshold,scale,shape,'GPD',periods_per_year,zeta_u)
+
+            N = np.arange(len(coefs_bs))
             out = xr.DataArray(dims=['return period','N'],coords={'return period':times,'N':N},data=return_levels,name='return level')
             out['N'].attrs['long_name'] = 'Number of bootstrapping samples'
 
@@ -155,22 +192,11 @@ def fit_return_levels_sdfc(da,times,periods_per_year,kind,N_boot=None,full=False
             out = out.to_dataset()
             if N_boot is None:
                 out['mu'] = threshold
-                out['sigma'] = law_gpd.coef_[0]
-                out['xi'] = law_gpd.coef_[1]
+                out['sigma'] = scale
+                out['xi'] = shape
             else:
-                out['mu'] = xr.DataArray(dims=['N'],coords={'N':out['N']},data=threshold * np.ones(N_boot))
-
-                if not law_gpd._lhs.is_fixed('scale'):
-                    out['sigma'] = xr.DataArray(dims=['N'],coords={'N':out['N']},data=law_gpd.info_.coefs_bs_[:,0])
-                else:
-                    out['sigma'] = xr.DataArray(dims=['N'],coords={'N':out['N']},data=kwargs['f_scale'] * np.ones(N_boot))
-
-                if law_gpd._lhs.is_fixed('shape'):
-                    out['xi'] = xr.DataArray(dims=['N'],coords={'N':out['N']},data=kwargs['f_shape'] * np.ones(N_boot))
-                elif not law_gpd._lhs.is_fixed('shape') and law_gpd._lhs.is_fixed('scale'):
-                    out['xi'] = xr.DataArray(dims=['N'],coords={'N':out['N']},data=law_gpd.info_.coefs_bs_[:,0])
-                else:
-                    out['xi'] = xr.DataArray(dims=['N'],coords={'N':out['N']},data=law_gpd.info_.coefs_bs_[:,1])
+                for name,value in zip(('mu','sigma','xi'),(threshold,scale,shape)):
+                    out[name] = xr.DataArray(dims=['N'],coords={'N':out['N']},data=value * np.ones(out['N'].size))
             out['return_level_obs'] = return_period_obs(da,periods_per_year,threshold=threshold).rename({'return period':'return_period_obs'})
         if model is True:
             return out, law_gpd
@@ -178,48 +204,34 @@ def fit_return_levels_sdfc(da,times,periods_per_year,kind,N_boot=None,full=False
             return out
     elif kind.upper() == 'GEV':
         law_gev = sd.GEV(method = method.lower())
-        if N_boot:
+        if N_boot and own_bootstrap:
+            law_gev.fit(Y,**kwargs)
+            coefs_bs = bootstrap_sdfc(Y,kind,N_boot,method,rng,n_jobs,executor,**kwargs)
+        elif N_boot:
             law_gev.fit_bootstrap(Y,n_bootstrap=N_boot,alpha=0.05,**kwargs)
+            coefs_bs = law_gev.info_.coefs_bs_
         else:
             law_gev.fit(Y,**kwargs)
 
         # zeta_u = Y[Y>threshold].size / Y.size # fraction of points exceeding threshold
         # According to Coles 2001, Eq. 4.13 ff
 
-        yp = -np.log(1 - 1/times)
-
         if not N_boot:
-            loc, scale, shape = law_gev.coef_
+            loc, scale, shape = _law_parameters(law_gev,('loc','scale','shape'),law_gev.coef_,kwargs)[0]
             mu, sigma, xi = loc, scale, shape
             # Coles, 3.10 (page 56, section 3.3.3)
-            return_levels = loc - scale / shape  * ( 1 - yp[:,None]**(-shape))
-            out = xr.DataArray(dims=['return period'],coords={'return period':times},data=np.squeeze(return_levels),name='return level')
+            return_levels = return_level_kernel(times,loc,scale,shape,'GEV')
+            out = xr.DataArray(dims=['return period'],coords={'return period':times},data=return_levels,name='return level')
         else:
-            N = np.arange(law_gev.info_.n_bootstrap) # bootstrap coordinate
-            params_fixed =  [law_gev._lhs.is_fixed('loc'), law_gev._lhs.is_fixed('scale'), law_gev._lhs.is_fixed('shape')]
-            if params_fixed == [True, True, True]: # fixed all 
+            N = np.arange(len(coefs_bs)) # bootstrap coordinate
+            (loc, scale, shape), fitted = _law_parameters(law_gev,('loc','scale','shape'),coefs_bs,kwargs)
+            if not any(fitted): # fixed all
                 print('Error - cannot fix all parameters')
                 return None
-            elif params_fixed == [True, True, False]: # fixed location, scale
-                loc, scale, shape = kwargs['f_loc'], kwargs['f_scale'], law_gev.info_.coefs_bs_[:,0]
-                mu, sigma, xi = loc, scale, xr.DataArray(dims=['N'],coords={'N':N},data=shape,name='xi')
-            elif params_fixed == [True, False, True]: # fixed location, shape
-                loc, scale, shape = kwargs['f_loc'], law_gev.info_.coefs_bs_[:,0], kwargs['f_shape']
-                mu, sigma, xi = loc, xr.DataArray(dims=['N'],coords={'N':N},data=scale,name='sigma'), shape
-            elif params_fixed == [False, True, True]: # fixed scale, shape
-                loc, scale, shape = law_gev.info_.coefs_bs_[:,0], kwargs['f_scale'], kwargs['f_shape']
-                mu, sigma, xi = xr.DataArray(dims=['N'],coords={'N':N},data=loc,name='mu'), scale, shape
-            elif params_fixed == [False, True, False]: # fixed scale
-                loc, scale, shape = law_gev.info_.coefs_bs_[:,0], kwargs['f_scale'], law_gev.info_.coefs_bs_[:,1]
-                mu, sigma, xi = xr.DataArray(dims=['N'],coords={'N':N},data=loc,name='mu'), scale, xr.DataArray(dims=['N'],coords={'N':N},data=shape,name='xi')
-            elif params_fixed == [False, False, True]: # fixed shape
-                loc, scale, shape = law_gev.info_.coefs_bs_[:,0], law_gev.info_.coefs_bs_[:,1], kwargs['f_shape']
-                mu, sigma, xi = xr.DataArray(dims=['N'],coords={'N':N},data=loc,name='mu'), xr.DataArray(dims=['N'],coords={'N':N},data=scale,name='sigma'), shape
-            elif params_fixed == [False, False, False]: # fixed none of loc, scale, shape
-                loc, scale, shape = law_gev.info_.coefs_bs_.T
-                mu, sigma, xi = xr.DataArray(dims=['N'],coords={'N':N},data=loc,name='mu'), xr.DataArray(dims=['N'],coords={'N':N},data=scale,name='sigma'), xr.DataArray(dims=['N'],coords={'N':N},data=shape,name='xi')
-
-            return_levels = loc - scale / shape  * ( 1 - yp[:,None]**(-shape))
+            mu, sigma, xi = [xr.DataArray(dims=['N'],coords={'N':N},data=value,name=name) if free else value
+                             for value,name,free in zip((loc,scale,shape),('mu','sigma','xi'),fitted)]
+
+            return_levels = return_level_kernel(times[:,None],loc,scale,shape,'GEV')
             out = xr.DataArray(dims=['return period','N'],coords={'return period':times,'N':N},data=return_levels,name='return level')
             out['N'].attrs['long_name'] = 'Number of bootstrapping samples'
 
@@ -243,9 +255,66 @@ def fit_return_levels_sdfc(da,times,periods_per_year,kind,N_boot=None,full=False
     else:
         raise ValueError('kind %s is not defined' % kind)
     
-def fit_return_levels_sdfc_2d(da,times,periods_per_year,kind,N_boot,percentile=None,full=False,method='mle',**kwargs):
+def _fit_cells(values,times,periods_per_year,kind,N_boot,full,method,rng,kwargs):
+    '''
+    fit_return_levels_sdfc for each column of values (time, cells), as a list of
+    Datasets (None where it returns None, or the fit breaks down numerically with a
+    singular matrix); other errors propagate. kwargs values are scalars or arrays
+    with one entry per cell, rng a list of per-cell seeds or None.
     '''
-    Iterate over latitude, longitude and fit indendently at each location, same threshold
+    out = []
+    for c in range(values.shape[1]):
+        kwargs_c = {key: float(value[c]) if isinstance(value,np.ndarray) else value
+                    for key,value in kwargs.items()}
+        try:
+            tmp = fit_return_levels_sdfc(values[:,c],times=times,periods_per_year=periods_per_year,kind=kind,
+                                         N_boot=N_boot,full=full,method=method,
+                                         rng=None if rng is None else rng[c],**kwargs_c)
+        except np.linalg.LinAlgError as e:
+            print('Error in cell %i: %s' % (c,e))
+            tmp = None
+        if isinstance(tmp,xr.DataArray):
+            tmp = tmp.to_dataset()
+        out.append(tmp)
+    return out
+
+def _assemble_cells(results,shape,coords):
+    '''
+    Gather per-cell Datasets into one Dataset with the spatial dims (shape, coords)
+    first. Dimensions that differ between cells (the observed return periods) are
+    outer-joined; missing entries and failed cells are NaN.
+    '''
+    template = next(r for r in results if r is not None)
+    # union of the coordinates of every non-spatial dimension
+    dim_coords = {}
+    for dim in template.dims:
+        if dim in template.coords:
+            values = np.unique(np.concatenate([r[dim].values for r in results if r is not None]))
+        else:
+            values = np.arange(max(r.sizes[dim] for r in results if r is not None))
+        dim_coords[dim] = values
+    data_vars = {}
+    for name, var in template.data_vars.items():
+        data = np.full((len(results),) + tuple(dim_coords[d].size for d in var.dims),np.nan)
+        for c, r in enumerate(results):
+            if r is None or name not in r:
+                continue
+            index = [np.searchsorted(dim_coords[d],r[d].values) if d in r.coords else np.arange(r.sizes[d])
+                     for d in r[name].dims]
+            data[(c,) + np.ix_(*index)] = r[name].values
+        data = data.reshape(shape + data.shape[1:])
+        data_vars[name] = (list(coords) + list(var.dims),data,var.attrs)
+    out = xr.Dataset(data_vars,coords=dict(coords,**{d: v for d,v in dim_coords.items() if d in template.coords}),
+                     attrs=template.attrs)
+    for dim in out.dims:
+        if dim in template.coords:
+            out[dim].attrs = template[dim].attrs
+    return out
+
+def fit_return_levels_sdfc_2d(da,times,periods_per_year,kind,N_boot,percentile=None,full=False,method='mle',
+                              n_jobs=1,executor=None,chunk_size=None,rng=None,batched=False,**kwargs):
+    '''
+    Fit independently at each location (latitude, longitude), same threshold
     - full: also get obs and parameters at each location
     - need ONLY one of threshold, percentile
         if threshold: fixed threshold for each point
@@ -256,7 +325,20 @@ def fit_return_levels_sdfc_2d(da,times,periods_per_year,kind,N_boot,percentile=N
         those are either:
             -single float value - then the parameter is set for the entire 2d region
             -dataarray with same grid as da - then the parameter is set per gridpoint
+    - n_jobs, executor: the grid cells are stacked and fitted in chunks of chunk_size
+      cells (default: 4 chunks per worker) on n_jobs processes (all cores for None) or
+      a concurrent.futures executor (e.g. a dask.distributed client.get_executor())
+    - rng: seed, SeedSequence or numpy Generator for reproducible bootstrap (see
+      gev_functions.bootstrap_seeds); each cell gets its own spawned stream, drawn
+      from the global numpy random state if rng is None
+    - batched: GPD MLE without bootstrap and with at most f_loc, f_shape fixed is
+      fitted for all cells at once with fit_return_levels_gpd_2d
+    The output has the layout of xr.concat over the cells: dims latitude, longitude,
+    then those of fit_return_levels_sdfc, with the observed return periods outer-joined.
     '''
+    if (batched and kind.upper() == 'GPD' and not N_boot and method.lower() == 'mle'
+            and set(kwargs) <= {'f_loc','f_shape'}):
+        return fit_return_levels_gpd_2d(da,times,periods_per_year,percentile=percentile,full=full,**kwargs)
     if kind.upper() == 'GPD':
         if not 'f_loc' in kwargs.keys() and percentile is not None:
             print('Fixed percentile')
@@ -266,45 +348,283 @@ def fit_return_levels_sdfc_2d(da,times,periods_per_year,kind,N_boot,percentile=N
             print('GPD: ERROR: Need to set ONLY ONE of threshold, percentile')
             return 
 
-    func = fit_return_levels_sdfc
-    tmps = []
-    i = 1
-    for lati in da['latitude'].values:
-        print('Latitude: %i / %i : %.1f' % (i,da['latitude'].size,lati))
-        i += 1
-        tmpsi = []
-        for loni in da['longitude'].values:
-            dai = da.sel(latitude=lati,longitude=loni)
-            kwargs2 = {}
-            for key in kwargs.keys():
-                if isinstance(kwargs[key],xr.DataArray):
-                    kwargs2[key] = float(kwargs[key].sel(latitude=lati,longitude=loni))
-                else:
-                    kwargs2[key] = kwargs[key]
-
-            if kind.upper() == 'GPD' and percentile is not None:
-                kwargs2['f_loc'] = np.quantile(dai.values,percentile)
-            # tmp = ex.fit_return_levels(dai,threshold=threshold,times=times,periods_per_year=periods_per_year,N_boot=N_boot,full=full)
-            tmp = func(dai,times=times,periods_per_year=periods_per_year,kind=kind,N_boot=N_boot,full=full,method=method,**kwargs2)
-            # tmp['longitude'] = loni
-            # # tmp['latitude'] = lati
-            # tmpsi.append(tmp)
-            # print(loni)
-            # # return tmp
-            try:
-                # tmp['N']
-                tmp['longitude'] = loni
-                # tmp['latitude'] = lati
-                tmpsi.append(tmp)
-            except:
-                print('Error, no N')
-
-        tmpsi = xr.concat(tmpsi,'longitude')
-        tmpsi['latitude'] = lati
-        tmps.append(tmpsi)
-    tmps = xr.concat(tmps,'latitude')
-    return tmps
+    spatial = ('latitude','longitude')
+    stacked = da.transpose(*[d for d in da.dims if d not in spatial],*spatial).stack(cell=spatial)
+    values = stacked.values
+    n_cells = values.shape[1]
+    cell_kwargs = {}
+    for key,value in kwargs.items():
+        if isinstance(value,xr.DataArray):
+            cell_kwargs[key] = value.stack(cell=spatial).sel(cell=stacked['cell']).values.astype(float)
+        else:
+            cell_kwargs[key] = value
+    if kind.upper() == 'GPD' and percentile is not None:
+        cell_kwargs['f_loc'] = np.quantile(values,percentile,axis=0)
+    # one independent stream per cell, also for rng=None, so no two cells or chunks repeat draws
+    seeds = [seed for _,seed in bootstrap_seeds(rng,n_cells,block_size=1)] if N_boot else None
+
+    if chunk_size is None:
+        workers = 1 if n_jobs == 1 and executor is None else (n_jobs or os.cpu_count())
+        chunk_size = max(1,-(-n_cells // (4 * workers)))
+    blocks = []
+    for start in range(0,n_cells,chunk_size):
+        cells = slice(start,start + chunk_size)
+        blocks.append((values[:,cells],times,periods_per_year,kind,N_boot,full,method,
+                       None if seeds is None else seeds[cells],
+                       {key: value[cells] if isinstance(value,np.ndarray) else value
+                        for key,value in cell_kwargs.items()}))
+    results = [r for block in map_blocks(_fit_cells,blocks,n_jobs,executor) for r in block]
+    if all(r is None for r in results):
+        print('Error, no successful fit')
+        return None
+
+    coords = {d: da[d].values for d in spatial}
+    out = _assemble_cells(results,(da['latitude'].size,da['longitude'].size),coords)
+    if 'units' in da.attrs:
+        out['return level'].attrs['units'] = da.attrs['units']
+    if not full:
+        out = out['return level']
+    return out
     
+def exceedances_csr(values,thresholds):
+    '''
+    Peaks over threshold of each column of values (time, cells), packed CSR-style:
+    the excesses values - threshold > 0 of cell c are excess[offsets[c]:offsets[c+1]],
+    in time order. NaNs never exceed. Returns offsets, excess.
+    '''
+    exceed = (values > thresholds).T
+    counts = exceed.sum(axis=1)
+    offsets = np.concatenate([[0],np.cumsum(counts)])
+    excess = (values.T - thresholds[:,None])[exceed]
+    return offsets, excess
+
+def _gpd_sums(cell,excess,n_cells,log_scale,xi):
+    '''
+    Per-cell sums of the GPD log-likelihood terms over the CSR excesses
+    '''
+    # the xi -> 0 (exponential) limit cancels badly in floating point; evaluate just beside it
+    xi = np.where(np.abs(xi) < 1e-5,np.where(xi < 0,-1e-5,1e-5),xi)
+    a = excess * np.exp(-log_scale)[cell]
+    w = 1 + xi[cell] * a
+    outside = np.bincount(cell,weights=w <= 0,minlength=n_cells) > 0
+    w = np.where(w > 0,w,1.)
+    sums = [np.bincount(cell,weights=x,minlength=n_cells) for x in (np.log(w),a / w,a / w**2,a**2 / w**2)]
+    return xi, outside, sums
+
+def fit_gpd_batch(offsets,excess,f_shape=None,maxiter=100,tol=1e-6):
+    '''
+    Maximum-likelihood GPD fit (scale, shape) of the excesses of every cell at once,
+    from the CSR layout of exceedances_csr; the shape follows Coles (2001) and SDFC.
+    Starts from the method-of-moments estimates and iterates damped Newton steps on
+    all cells together, with the analytic gradient and Hessian accumulated per
+    cell with np.bincount. With f_shape (scalar or per cell) only the scale is
+    fitted. Cells with fewer than 2 excesses give NaN.
+    Returns scale, shape arrays.
+    '''
+    n_cells = offsets.size - 1
+    k = np.diff(offsets).astype(float)
+    cell = np.repeat(np.arange(n_cells),np.diff(offsets))
+    mean = np.bincount(cell,weights=excess,minlength=n_cells) / np.maximum(k,1)
+    var = np.bincount(cell,weights=(excess - mean[cell])**2,minlength=n_cells) / np.maximum(k - 1,1)
+    largest = np.zeros(n_cells)
+    np.maximum.at(largest,cell,excess)
+    if f_shape is None:
+        xi = 0.5 * (1 - mean**2 / var)
+    else:
+        xi = np.broadcast_to(np.asarray(f_shape,dtype=float),(n_cells,)).copy()
+    scale = np.where(xi < 1,mean * (1 - xi),mean)
+    # keep the largest excess inside the support of a bounded (xi < 0) start
+    scale = np.where(xi < 0,np.maximum(scale,-1.01 * xi * largest),scale)
+    theta = np.stack([np.log(scale),xi],axis=1)
+    theta[k < 2] = np.nan
+
+    def nll_grad_hess(theta):
+        xi, outside, (s_log,s_a,s_a2,s_aa) = _gpd_sums(cell,excess,n_cells,theta[:,0],theta[:,1])
+        nll = k * theta[:,0] + (1 + 1 / xi) * s_log
+        grad = np.stack([k - (1 + xi) * s_a,-s_log / xi**2 + (1 + 1 / xi) * s_a],axis=1)
+        hess = np.empty((n_cells,2,2))
+        hess[:,0,0] = (1 + xi) * s_a2
+        hess[:,0,1] = hess[:,1,0] = -s_a + (1 + xi) * s_aa
+        hess[:,1,1] = 2 * s_log / xi**3 - 2 * s_a / xi**2 - (1 + 1 / xi) * s_aa
+        return np.where(outside,np.inf,nll), grad, hess
+
+    free = [0] if f_shape is not None else [0,1]
+    nll, grad, hess = nll_grad_hess(np.nan_to_num(theta))
+    damping = np.full(n_cells,1e-3)
+    active = np.isfinite(nll) & (k >= 2)
+    for i in range(maxiter):
+        if not active.any():
+            break
+        g = grad[:,free]
+        h = hess[:,free][:,:,free]
+        diagonal = np.abs(np.diagonal(h,axis1=1,axis2=2)) + 1e-12
+        with np.errstate(all='ignore'):
+            step = -np.linalg.solve(h + damping[:,None,None] * diagonal[:,:,None] * np.eye(len(free)),g[:,:,None])[:,:,0]
+        step = np.where(np.isfinite(step),step,0.)
+        trial = theta.copy()
+        trial[:,free] += np.where(active[:,None],step,0.)
+        nll_t, grad_t, hess_t = nll_grad_hess(np.nan_to_num(trial))
+        better = active & (nll_t <= nll)
+        theta[better], nll[better], grad[better], hess[better] = trial[better], nll_t[better], grad_t[better], hess_t[better]
+        damping = np.where(better,np.maximum(damping / 10,1e-12),damping * 10)
+        done = (better & (np.abs(step).max(axis=1) < tol)) | (np.abs(grad[:,free]).max(axis=1) < tol) | (damping > 1e12)
+        active &= ~done
+    theta[~np.isfinite(nll)] = np.nan
+    return np.exp(theta[:,0]), theta[:,1]
+
+def _fit_gpd_cells(values,thresholds,times,periods_per_year,f_shape=None):
+    '''
+    Batched GPD fit of the exceedances of each column of values (time, cells) over
+    thresholds (cells,). Returns return levels (cells, times), scale, shape and the
+    CSR exceedances offsets, excess.
+    '''
+    offsets, excess = exceedances_csr(values,thresholds)
+    scale, shape = fit_gpd_batch(offsets,excess,f_shape=f_shape)
+    zeta_u = np.diff(offsets) / np.sum(~np.isnan(values),axis=0)
+    return_levels = return_level_kernel(times[None,:],thresholds[:,None],scale[:,None],shape[:,None],
+                                        'GPD',periods_per_year,zeta_u[:,None])
+    return return_levels, scale, shape, offsets, excess
+
+def fit_return_levels_gpd_2d(da,times,periods_per_year,percentile=None,full=False,f_loc=None,f_shape=None):
+    '''
+    Batched peaks-over-threshold GPD fit at every location (latitude, longitude),
+    without bootstrap: same output layout as fit_return_levels_sdfc_2d(..., kind='GPD',
+    N_boot=None), without a per-cell Python object.
+    - need ONLY one of f_loc (threshold: float or DataArray on the grid), percentile
+    - f_shape: optional fixed shape
+    The per-cell percentile thresholds are one reduction along time, the exceedances
+    are packed with exceedances_csr and all cells are fitted with fit_gpd_batch.
+    '''
+    if (f_loc is None) == (percentile is None):
+        print('GPD: ERROR: Need to set ONLY ONE of threshold, percentile')
+        return
+    spatial = ('latitude','longitude')
+    stacked = da.transpose(*[d for d in da.dims if d not in spatial],*spatial).stack(cell=spatial)
+    values = stacked.values.reshape(-1,stacked['cell'].size)
+    if percentile is not None:
+        thresholds = np.quantile(values,percentile,axis=0)
+    elif isinstance(f_loc,xr.DataArray):
+        thresholds = f_loc.stack(cell=spatial).sel(cell=stacked['cell']).values.astype(float)
+    else:
+        thresholds = np.full(values.shape[1],float(f_loc))
+    if isinstance(f_shape,xr.DataArray):
+        f_shape = f_shape.stack(cell=spatial).sel(cell=stacked['cell']).values.astype(float)
+    return_levels, scale, shape, offsets, excess = _fit_gpd_cells(values,thresholds,times,periods_per_year,f_shape)
+    k = np.diff(offsets)
+
+    grid = (da['latitude'].size,da['longitude'].size)
+    coords = {d: da[d].values for d in spatial}
+    coords['return period'] = times
+    out = xr.DataArray(dims=list(spatial) + ['return period'],coords=coords,
+                       data=return_levels.reshape(grid + (times.size,)),name='return level')
+    out['return period'].attrs['units'] = 'year'
+    if 'units' in da.attrs:
+        out.attrs['units'] = da.attrs['units']
+    if not full:
+        return out
+    out = out.to_dataset()
+    out['mu'] = (spatial,thresholds.reshape(grid))
+    out['sigma'] = (spatial,scale.reshape(grid))
+    out['xi'] = (spatial,shape.reshape(grid))
+    # observed return levels as in return_period_obs, outer-joined over the cells
+    levels, ranks, N = empirical_ranks(values,axis=0,threshold=thresholds,ties='ordinal')
+    with np.errstate(divide='ignore',invalid='ignore'):
+        periods = 1 / (ranks / (k[:,None] + 1) * periods_per_year * (k / N)[:,None])
+    cell, column = np.nonzero(~np.isnan(ranks))
+    periods = periods[cell,column]
+    union = np.unique(periods)
+    obs = np.full((k.size,union.size),np.nan)
+    obs[cell,np.searchsorted(union,periods)] = levels[cell,column]
+    out['return_level_obs'] = (list(spatial) + ['return_period_obs'],obs.reshape(grid + (union.size,)))
+    out['return_period_obs'] = union
+    out['return_period_obs'].attrs['units'] = 'year'
+    return out
+
+def _return_period_obs_block(data,threshold,periods,periods_per_year):
+    # threshold is a plain float when return_period_obs_map gets a scalar (or none)
+    threshold = np.asarray(threshold,dtype=float)
+    data = np.sort(data,axis=-1)
+    N = np.sum(~np.isnan(data),axis=-1)[...,None]
+    k = np.sum(data > threshold[...,None],axis=-1)[...,None]
+    # rank i of the exceedances (return_period_obs) with return period `periods`
+    with np.errstate(divide='ignore',invalid='ignore'):
+        rank = k + 1 - (k + 1) * N / (k * periods * periods_per_year)
+    inside = (rank >= 1) & (rank <= k)
+    position = np.where(inside,N - k + rank - 1,0)
+    lower = np.floor(position).astype(int)
+    upper = np.minimum(lower + 1,data.shape[-1] - 1)
+    weight = position - lower
+    low = np.take_along_axis(data,lower,axis=-1)
+    high = np.take_along_axis(data,upper,axis=-1)
+    return np.where(inside,np.where(weight > 0,low + weight * (high - low),low),np.nan)
+
+def return_period_obs_map(da,periods,periods_per_year,threshold=None,dim='time'):
+    '''
+    Empirical return levels of return_period_obs at the return periods `periods`
+    (years) for every series along dim of da, interpolated between the ranks, NaN
+    outside the observed range. Missing values are skipped.
+    - threshold: optional float or DataArray over the other dims of da
+    Lazy and chunk by chunk for dask-backed da (time is kept in one chunk).
+    '''
+    periods = np.asarray(periods,dtype=float)
+    if threshold is None:
+        threshold = -np.inf
+    out = xr.apply_ufunc(
+        _return_period_obs_block,_time_last(da,dim),threshold,
+        kwargs={'periods':periods,'periods_per_year':periods_per_year},
+        input_core_dims=[[dim],[]],output_core_dims=[['return period']],
+        dask='parallelized',output_dtypes=[float],
+        dask_gufunc_kwargs={'output_sizes':{'return period':periods.size}})
+    out = out.assign_coords({'return period':periods}).rename('return level')
+    out['return period'].attrs['units'] = 'year'
+    return out
+
+def _fit_return_levels_sdfc_block(data,*params,keys,times,periods_per_year,kind,percentile,method,batched,kwargs):
+    values = data.reshape(-1,data.shape[-1]).T
+    kwargs = dict(kwargs)
+    for key,param in zip(keys,params):
+        kwargs[key] = np.broadcast_to(param,data.shape[:-1]).ravel().astype(float)
+    if kind.upper() == 'GPD' and percentile is not None:
+        kwargs['f_loc'] = np.nanquantile(values,percentile,axis=0)
+    if (batched and kind.upper() == 'GPD' and method.lower() == 'mle'
+            and set(kwargs) <= {'f_loc','f_shape'}):
+        thresholds = np.broadcast_to(np.asarray(kwargs['f_loc'],dtype=float),(values.shape[1],))
+        levels = _fit_gpd_cells(values,thresholds,times,periods_per_year,kwargs.get('f_shape'))[0]
+    else:
+        results = _fit_cells(values,times,periods_per_year,kind,None,False,method,None,kwargs)
+        levels = np.array([np.full(times.size,np.nan) if r is None else r['return level'].values
+                           for r in results]).reshape(-1,times.size)
+    return levels.reshape(data.shape[:-1] + (times.size,))
+
+def fit_return_levels_sdfc_map(da,times,periods_per_year,kind,percentile=None,method='mle',dim='time',
+                               batched=False,**kwargs):
+    '''
+    Return level maps of fit_return_levels_sdfc (without bootstrap) for every series
+    along dim of da, e.g. on a (latitude, longitude) grid; arguments as for
+    fit_return_levels_sdfc_2d, fixed parameters in kwargs as floats or DataArrays
+    over the other dims of da.
+    Lazy and chunk by chunk for dask-backed da (time is kept in one chunk): nothing
+    is loaded or fitted before .compute()/.load(), then each chunk is fitted by
+    its dask worker. batched=True fits GPD MLE chunks at once (fit_gpd_batch).
+    '''
+    if kind.upper() == 'GPD' and ('f_loc' in kwargs) == (percentile is not None):
+        print('GPD: ERROR: Need to set ONLY ONE of threshold, percentile')
+        return
+    times = np.asarray(times,dtype=float)
+    keys = [key for key,value in kwargs.items() if isinstance(value,xr.DataArray)]
+    out = xr.apply_ufunc(
+        _fit_return_levels_sdfc_block,_time_last(da,dim),*[kwargs.pop(key) for key in keys],
+        kwargs={'keys':keys,'times':times,'periods_per_year':periods_per_year,'kind':kind,
+                'percentile':percentile,'method':method,'batched':batched,'kwargs':kwargs},
+        input_core_dims=[[dim]] + [[]] * len(keys),output_core_dims=[['return period']],
+        dask='parallelized',output_dtypes=[float],
+        dask_gufunc_kwargs={'output_sizes':{'return period':times.size}})
+    out = out.assign_coords({'return period':times}).rename('return level')
+    out['return period'].attrs['units'] = 'year'
+    if 'units' in da.attrs:
+        out.attrs['units'] = da.attrs['units']
+    return out
+
 def plot_levels_from_obj(da,ax=None,alpha=None,lw=3,c='C0',obs=True,marker='o',markersize=5,mec='k',**kwargs):
     '''
     Plot results from 1D object returned from fit_return_levels
@@ -1,7 +1,8 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
 import numpy as np
-from scipy import stats
+from scipy.special import gamma
 from scipy.stats import genextreme as gev
-import pandas as pd
 import xarray as xr
 import matplotlib.pyplot as plt
 
@@ -12,35 +13,282 @@ def estimate_return_level(quantile,loc,scale,shape):
 def estimate_return_level_period(period,loc,scale,shape):
     '''
     Compute GEV-based return level for a given return period, and GEV parameters
+    (shape in the scipy.stats.genextreme convention), broadcasting as numpy does
     '''
-    return gev.ppf(1-1/period,shape,loc=loc,scale=scale)
+    return return_level_kernel(period,loc,scale,-np.asarray(shape,dtype=float))
+
+def return_level_kernel(periods,loc,scale,xi,kind='GEV',periods_per_year=1,zeta_u=1.):
+    '''
+    Return levels of the GEV (Coles 2001, Eq. 3.4) or GPD (Eq. 4.13) for return periods
+    in years, all arguments broadcast against each other (e.g. periods[:,None,None],
+    bootstrap replicates [:,None], cells). xi follows Coles and SDFC (the negative of
+    the scipy.stats.genextreme shape). Written as expm1(xi*log(x))/xi, which is exact
+    down to the Gumbel/exponential limit xi = 0.
+    - GPD: loc is the threshold, periods_per_year and zeta_u (fraction of values
+      above the threshold) convert the return periods into numbers of exceedances
+    '''
+    periods = np.asarray(periods,dtype=float)
+    xi = np.asarray(xi,dtype=float)
+    if kind.upper() == 'GEV':
+        # -log(y_p), y_p = -log(1 - 1/T)
+        log_x = -np.log(-np.log1p(-1 / periods))
+    elif kind.upper() == 'GPD':
+        log_x = np.log(periods * periods_per_year * zeta_u)
+    else:
+        raise ValueError('kind %s is not defined' % kind)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        growth = np.where(xi == 0,log_x,np.expm1(xi * log_x) / xi)
+    return loc + scale * growth
+
+def return_level_quantiles(q,axis,periods,loc,scale,xi,kind='GEV',periods_per_year=1,zeta_u=1.,
+                           chunk_size=2**24):
+    '''
+    np.quantile(return_level_kernel(periods,loc,scale,xi,...),q,axis=axis), e.g. the
+    bootstrap ranges of a (periods, replicates, cells) cube, without holding the cube:
+    it is evaluated in slices along its largest other axis of about chunk_size values.
+    '''
+    arrays = [np.asarray(a,dtype=float) for a in (periods,loc,scale,xi,zeta_u)]
+    ndim = max(a.ndim for a in arrays)
+    # the quantile axis last, so each chunk is reduced along contiguous memory
+    arrays = [np.moveaxis(a.reshape((1,) * (ndim - a.ndim) + a.shape),axis,-1) for a in arrays]
+    shape = np.broadcast_shapes(*[a.shape for a in arrays])
+    q = np.asarray(q,dtype=float)
+    if ndim == 1:
+        return np.quantile(return_level_kernel(*arrays[:4],kind,periods_per_year,arrays[4]),q)
+    out = np.empty(q.shape + shape[:-1])
+    split = int(np.argmax(shape[:-1]))
+    step = max(1,chunk_size * shape[split] // max(1,np.prod(shape)))
+    for start in range(0,shape[split],step):
+        index = (slice(None),) * split + (slice(start,start + step),)
+        chunk = [a[index] if a.shape[split] > 1 else a for a in arrays]
+        levels = return_level_kernel(*chunk[:4],kind,periods_per_year,chunk[4])
+        levels = np.broadcast_to(levels,shape[:split] + (levels.shape[split],) + shape[split + 1:])
+        out[(slice(None),) * q.ndim + index] = np.quantile(levels,q,axis=-1)
+    return out
+
+def empirical_ranks(data,axis=-1,top=None,threshold=None,ties='average'):
+    '''
+    The largest values of data along axis, ascending, with their descending ranks,
+    without sorting the whole sample: values not above threshold (float or array over
+    the other axes) are dropped before sorting, and with top (or a threshold) only
+    the largest values are split off with np.partition and sorted.
+    Ties get the average rank ('average', as stats.rankdata) or consecutive ranks
+    ('ordinal'), found in one pass over the sorted values. Missing values are ignored.
+    Returns levels, ranks (..., m), NaN-padded at the start where a series keeps
+    fewer values, and the number n of valid values of each series.
+    '''
+    x = np.moveaxis(np.asarray(data,dtype=float),axis,-1)
+    n = np.sum(~np.isnan(x),axis=-1)
+    if x.ndim == 1 and np.ndim(threshold) == 0:
+        x = x[~np.isnan(x)] if threshold is None else x[x > threshold]
+    else:
+        dropped = np.isnan(x) if threshold is None else ~(x > np.expand_dims(threshold,-1))
+        x = np.where(dropped,-np.inf,x)
+    size = x.shape[-1]
+    m = size if top is None else min(top,size)
+    if threshold is not None and x.ndim > 1:
+        m = min(m,int(np.max(np.sum(x > -np.inf,axis=-1),initial=0)))
+    if m < size:
+        x_top = np.sort(np.partition(x,size - m,axis=-1)[...,size - m:],axis=-1)
+    else:
+        x_top = np.sort(x,axis=-1)
+    position = np.arange(m)
+    if ties == 'average':
+        # groups of equal values: start and (exclusive) end position of each value's group
+        new = x_top[...,1:] != x_top[...,:-1]
+        first = np.concatenate([np.ones(x_top.shape[:-1] + (1,),bool),new],axis=-1)
+        last = np.concatenate([new,np.ones(x_top.shape[:-1] + (1,),bool)],axis=-1)
+        start = np.maximum.accumulate(np.where(first,position,0),axis=-1)
+        end = np.minimum.accumulate(np.where(last,position + 1,m)[...,::-1],axis=-1)[...,::-1]
+        equal = (end - start).astype(float)
+        if m < size:
+            # the lowest kept group may continue below the partition
+            lowest = start == 0
+            equal = np.where(lowest,np.sum(x == x_top[...,:1],axis=-1,keepdims=True),equal)
+        ranks = m - end + (equal + 1) / 2
+    else:
+        ranks = np.broadcast_to((m - position).astype(float),x_top.shape)
+    kept = x_top > -np.inf
+    return np.where(kept,x_top,np.nan), np.where(kept,ranks,np.nan), n
 
 def empirical_return_level(data):
     '''
     Compute empirical return level using the algorithm introduced in Tutorial 2
     '''
-    df = pd.DataFrame(index=np.arange(data.size))
-    # sort the data
-    df['sorted'] = np.sort(data)[::-1]
-    # rank via scipy instead to deal with duplicate values
-    df['ranks_sp'] = np.sort(stats.rankdata(-data))
-    # find exceedence probability
-    n = data.size
-    df['exceedance'] = df['ranks_sp']/(n+1)
+    levels, ranks, n = empirical_ranks(data)
+    # find exceedence probability, ranks with ties averaged as in stats.rankdata
+    exceedance = ranks / (n + 1)
     # find return period
-    df['period'] = 1 / df['exceedance']
-
-    df = df[::-1]
+    period = 1 / exceedance
 
     out = xr.DataArray(
         dims=['period'],
-        coords={'period':df['period']},
-        data=df['sorted'],name='level')
+        coords={'period':period},
+        data=levels,name='level')
     return out
 
-def fit_return_levels(data,years,N_boot=None,alpha=0.05):
+def _gev_nll_and_gradient(data,valid,loc,log_scale,xi):
+    '''
+    GEV negative log-likelihood of each series and its gradient with respect to
+    (loc, log scale, xi), where xi = -shape is the shape in the climate convention.
+    data is (n_series, n_years) with invalid (missing) values masked by valid.
+    Points outside the support give an infinite likelihood.
+    '''
+    # the xi -> 0 (Gumbel) limit cancels badly in floating point; evaluate just beside it
+    xi = np.where(np.abs(xi) < 1e-5, np.where(xi < 0, -1e-5, 1e-5), xi)[:,None]
+    scale = np.exp(log_scale)[:,None]
+    z = (data - loc[:,None]) / scale
+    y = np.where(valid, 1 + xi * z, 1.)
+    inside = np.all(y > 0, axis=1)
+    y = np.where(y > 0, y, 1.)
+    z = np.where(valid, z, 0.)
+    log_y = np.log(y)
+    t = np.where(valid, np.exp(-log_y / xi), 0.)
+    n = valid.sum(axis=1)
+    nll = n * log_scale + ((1 + 1 / xi) * log_y).sum(axis=1) + t.sum(axis=1)
+    valid_y = np.where(valid, 1 / y, 0.)
+    g_loc = (-(1 + xi) * valid_y + t * valid_y).sum(axis=1) / scale[:,0]
+    g_scale = n - ((1 + xi) * z * valid_y).sum(axis=1) + (t * z * valid_y).sum(axis=1)
+    g_xi = (-log_y / xi**2 + (1 + 1 / xi) * z * valid_y
+            + t * (log_y / xi**2 - z * valid_y / xi)).sum(axis=1)
+    nll = np.where(inside, nll, np.inf)
+    return nll, np.stack([g_loc, g_scale, g_xi], axis=1)
+
+def gev_pwm(data):
+    '''
+    Probability-weighted-moments (Hosking et al. 1985) estimates of the GEV
+    parameters of each row of data (n_series, n_years); NaNs are ignored.
+    Returns shape, loc, scale arrays, with shape in the scipy.stats.genextreme
+    convention (shape = -xi).
+    '''
+    data = np.atleast_2d(np.asarray(data,dtype=float))
+    x = np.sort(data, axis=1)  # NaNs sort last
+    n = np.sum(~np.isnan(data), axis=1)[:,None]
+    j = np.arange(data.shape[1])[None,:]
+    x = np.where(j < n, x, 0.)
+    b0 = x.sum(axis=1) / n[:,0]
+    b1 = (x * j / (n - 1)).sum(axis=1) / n[:,0]
+    b2 = (x * j * (j - 1) / ((n - 1) * (n - 2))).sum(axis=1) / n[:,0]
+    z = (2 * b1 - b0) / (3 * b2 - b0) - np.log(2) / np.log(3)
+    shape = 7.8590 * z + 2.9554 * z**2
+    # the shape = 0 (Gumbel) limit of the scale and location equations
+    small = np.abs(shape) < 1e-6
+    k = np.where(small, 1e-6, shape)
+    scale = np.where(small, (2 * b1 - b0) / np.log(2),
+                     (2 * b1 - b0) * k / (gamma(1 + k) * (1 - 2**(-k))))
+    loc = np.where(small, b0 - np.euler_gamma * scale,
+                   b0 + scale * (gamma(1 + k) - 1) / k)
+    return shape, loc, scale
+
+def fit_gev_batch(data,maxiter=100,tol=1e-6):
+    '''
+    Maximum-likelihood GEV fit of every row of data (n_series, n_years) at once.
+
+    Starts from the probability-weighted-moments estimates (gev_pwm; the Gumbel
+    fit where those put data outside the support) and iterates damped Newton
+    steps on all series together, with the analytic gradient of the
+    log-likelihood and a finite-difference Hessian. NaNs are treated as missing.
+    Returns shape, loc, scale arrays in the scipy.stats.genextreme convention,
+    i.e. the same parameters as gev.fit(row) for each row.
+    '''
+    data = np.atleast_2d(np.asarray(data,dtype=float))
+    valid = ~np.isnan(data)
+    data = np.where(valid, data, 0.)
+    shape, loc, scale = gev_pwm(np.where(valid, data, np.nan))
+    theta = np.stack([loc, np.log(scale), -shape], axis=1)
+    nll, grad = _gev_nll_and_gradient(data, valid, *theta.T)
+    # Gumbel start where the PWM estimates do not cover the data
+    gumbel = ~np.isfinite(nll)
+    if gumbel.any():
+        x = np.where(valid[gumbel], data[gumbel], np.nan)
+        scale0 = np.sqrt(6) * np.nanstd(x, axis=1) / np.pi
+        theta[gumbel] = np.stack([np.nanmean(x, axis=1) - np.euler_gamma * scale0,
+                                  np.log(scale0), np.zeros(gumbel.sum())], axis=1)
+        nll, grad = _gev_nll_and_gradient(data, valid, *theta.T)
+    damping = np.full(len(data), 1e-3)
+    eye = np.eye(3)
+    active = np.isfinite(nll)
+    h = 1e-5
+    for _ in range(maxiter):
+        if not active.any():
+            break
+        idx = np.flatnonzero(active)
+        th, g = theta[idx], grad[idx]
+        # Hessian by central differences of the analytic gradient
+        hessian = np.empty((idx.size, 3, 3))
+        for i in range(3):
+            step = np.zeros(3)
+            step[i] = h
+            _, gp = _gev_nll_and_gradient(data[idx], valid[idx], *(th + step).T)
+            _, gm = _gev_nll_and_gradient(data[idx], valid[idx], *(th - step).T)
+            hessian[:,:,i] = (gp - gm) / (2 * h)
+        hessian = 0.5 * (hessian + hessian.transpose(0,2,1))
+        diagonal = np.abs(np.diagonal(hessian, axis1=1, axis2=2)) + 1e-12
+        system = hessian + damping[idx,None,None] * diagonal[:,:,None] * eye
+        with np.errstate(all='ignore'):
+            delta = -np.linalg.solve(system, g[:,:,None])[:,:,0]
+        delta = np.where(np.isfinite(delta), delta, -1e-3 * g)
+        trial = th + delta
+        nll_trial, grad_trial = _gev_nll_and_gradient(data[idx], valid[idx], *trial.T)
+        better = nll_trial <= nll[idx]
+        accept = idx[better]
+        theta[accept], nll[accept], grad[accept] = trial[better], nll_trial[better], grad_trial[better]
+        damping[accept] = np.maximum(damping[accept] / 10, 1e-12)
+        damping[idx[~better]] *= 10
+        converged = (np.abs(delta).max(axis=1) < tol) & better \
+            | (np.abs(grad[idx]).max(axis=1) < tol) | (damping[idx] > 1e12)
+        active[idx[converged]] = False
+    return -theta[:,2], theta[:,0], np.exp(theta[:,1])
+
+def bootstrap_seeds(rng,N_boot,block_size=100):
+    '''
+    Split N_boot bootstrap replicates into blocks of block_size and give each block
+    an independent random stream spawned (numpy SeedSequence) from rng: a seed,
+    a SeedSequence, a numpy.random.Generator or None for a seed drawn from the
+    global numpy random state. Returns a list of (replicates, SeedSequence); the blocks depend only on
+    rng, N_boot and block_size, so results do not depend on how they are run.
+    '''
+    if rng is None:
+        rng = np.random.randint(0,2**31)
+    if isinstance(rng,np.random.Generator):
+        rng = rng.bit_generator.seed_seq
+    if isinstance(rng,np.random.SeedSequence):
+        seeds = rng.spawn((N_boot + block_size - 1) // block_size)
+    else:
+        seeds = np.random.SeedSequence(rng).spawn((N_boot + block_size - 1) // block_size)
+    sizes = [min(block_size,N_boot - i) for i in range(0,N_boot,block_size)]
+    return list(zip(sizes,seeds))
+
+def map_blocks(function,blocks,n_jobs=1,executor=None):
+    '''
+    [function(*block) for block in blocks], run on executor (a concurrent.futures
+    Executor) if given, else on a pool of n_jobs processes (all cores for None),
+    or serially for n_jobs=1
+    '''
+    if executor is not None:
+        return list(executor.map(function,*zip(*blocks)))
+    if n_jobs == 1:
+        return [function(*block) for block in blocks]
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        return list(pool.map(function,*zip(*blocks)))
+
+def _bootstrap_gev_block(data,size,seed):
+    '''
+    GEV fits (shape, loc, scale) of `size` resamples of data drawn with seed
+    '''
+    indices = np.random.default_rng(seed).integers(0,data.size,size=(size,data.size))
+    return fit_gev_batch(data[indices])
+
+def fit_return_levels(data,years,N_boot=None,alpha=0.05,rng=None,n_jobs=1,executor=None,block_size=100):
     '''
     Fit GEV to data, compute return levels and confidence intervals
+
+    The bootstrap resamples are drawn and fitted (with fit_gev_batch) in blocks of
+    block_size, each with its own random stream from bootstrap_seeds. rng is a
+    numpy.random.Generator or a seed for reproducible ranges; by default the
+    global numpy random state seeds them. The blocks are spread over n_jobs worker
+    processes or an executor (see map_blocks); the result for a given rng is the
+    same for any number of workers.
     '''
     empirical = empirical_return_level(data).rename({'period':'period_emp'}).rename('empirical')
     shape, loc, scale = gev.fit(data,0)
@@ -60,23 +308,12 @@ def fit_return_levels(data,years,N_boot=None,alpha=0.05):
     )
 
     if N_boot:
-        levels = []
-        shapes, locs, scales = [],[],[]
-        for i in range(N_boot):
-            datai = np.random.choice(data,size=data.size,replace=True)
-            # print(datai.mean())
-            shapei,loci,scalei = gev.fit(datai,0)
-            shapes.append(shapei)
-            locs.append(loci)
-            scales.append(scalei)
-            leveli = estimate_return_level_period(years,loci,scalei,shapei)
-            levels.append(
-                leveli
-            )
-
-        levels = np.array(levels)
+        data = np.asarray(data)
+        blocks = [(data,size,seed) for size, seed in bootstrap_seeds(rng,N_boot,block_size)]
+        fits = map_blocks(_bootstrap_gev_block,blocks,n_jobs,executor)
+        shapes, locs, scales = (np.concatenate(p) for p in zip(*fits))
         quant = alpha / 2, 1-alpha/2
-        quantiles = np.quantile(levels,quant,axis=0)
+        quantiles = return_level_quantiles(quant,0,np.asarray(years)[None,:],locs[:,None],scales[:,None],-shapes[:,None])
 
         print('Ranges with alpha=%.3f :' % alpha)
         print('Location: [%.2f , %.2f]'  % tuple(np.quantile(locs,quant).tolist()))
@@ -91,6 +328,115 @@ def fit_return_levels(data,years,N_boot=None,alpha=0.05):
         out['range'] = quantiles
     return out
 
+def _time_last(da,dim):
+    '''
+    da with dim as the last axis and, if it is dask-backed, in a single chunk along
+    dim, as xr.apply_ufunc(..., dask='parallelized') needs for a core dimension
+    '''
+    da = da.transpose(...,dim)
+    if da.chunks is not None:
+        da = da.chunk({dim:-1})
+    return da
+
+def _empirical_return_level_block(data,periods):
+    return np.moveaxis(np.nanquantile(data,1 - 1 / periods,axis=-1,method='weibull'),0,-1)
+
+def empirical_return_level_map(da,periods,dim='time'):
+    '''
+    Empirical return levels at the return periods `periods` (in time steps of dim)
+    of every series along dim of da, with the plotting positions rank/(n+1) of
+    empirical_return_level, interpolated between ranks (clamped to the observed
+    range). Missing values are skipped. Lazy and chunk by chunk for dask-backed da.
+    '''
+    periods = np.asarray(periods,dtype=float)
+    out = xr.apply_ufunc(
+        _empirical_return_level_block,_time_last(da,dim),
+        kwargs={'periods':periods},
+        input_core_dims=[[dim]],output_core_dims=[['period']],
+        dask='parallelized',output_dtypes=[float],
+        dask_gufunc_kwargs={'output_sizes':{'period':periods.size}})
+    return out.assign_coords(period=periods).rename('level')
+
+def _fit_return_levels_block(data,years):
+    shape, loc, scale = fit_gev_batch(data.reshape(-1,data.shape[-1]))
+    levels = estimate_return_level_period(years[None,:],loc[:,None],scale[:,None],shape[:,None])
+    return levels.reshape(data.shape[:-1] + (years.size,))
+
+def fit_return_levels_map(da,years,dim='time'):
+    '''
+    GEV return levels at the return periods `years` of every series along dim of da
+    (e.g. annual maxima on a grid), fitted with fit_gev_batch, without bootstrap.
+    Lazy and chunk by chunk for dask-backed da: each chunk of series is fitted at
+    once, keep the chunks along the other dims large enough for that to pay off.
+    '''
+    years = np.asarray(years,dtype=float)
+    out = xr.apply_ufunc(
+        _fit_return_levels_block,_time_last(da,dim),
+        kwargs={'years':years},
+        input_core_dims=[[dim]],output_core_dims=[['period']],
+        dask='parallelized',output_dtypes=[float],
+        dask_gufunc_kwargs={'output_sizes':{'period':years.size}})
+    return out.assign_coords(period=years).rename('GEV')
+
+def _time_chunks(source,variable,dim,time_chunk):
+    '''
+    Yield the data of source (NetCDF path, list of paths, Dataset or DataArray) in
+    loaded pieces of time_chunk steps along dim, one file after the other
+    '''
+    if isinstance(source,(str,os.PathLike)):
+        source = [source]
+    if isinstance(source,(list,tuple)):
+        for path in source:
+            with xr.open_dataset(path) as ds:
+                yield from _time_chunks(ds,variable,dim,time_chunk)
+        return
+    if isinstance(source,xr.Dataset):
+        source = source[variable] if variable is not None else source[list(source.data_vars)[0]]
+    source = source.transpose(dim,...)
+    for start in range(0,source.sizes[dim],time_chunk):
+        yield source.isel({dim:slice(start,start + time_chunk)}).load()
+
+def block_maxima_stream(source,variable=None,threshold=None,time_chunk=365,dim='time'):
+    '''
+    Annual (calendar year) maxima of source - a NetCDF file, a list of files, or a
+    (lazily opened) Dataset/DataArray - read time_chunk steps at a time, so only the
+    running maxima per year are kept in memory (years x grid, not days x grid).
+    - variable: data variable to use (default: the first one)
+    - threshold: optional float or DataArray on the grid, also count the values above it per year
+    Returns a Dataset over ('year', grid dims) with 'maxima', 'count' (number of valid
+    values) and, with a threshold, 'exceedances'; 'maxima' of a single series can be
+    passed to fit_return_levels, a grid to fit_return_levels_map(..., dim='year').
+    '''
+    blocks = {}
+    template = None
+    for chunk in _time_chunks(source,variable,dim,time_chunk):
+        if template is None:
+            template = chunk.isel({dim:0},drop=True)
+            if isinstance(threshold,xr.DataArray):
+                threshold = threshold.broadcast_like(template).transpose(*template.dims).values.ravel()
+        values = chunk.values.reshape(chunk.shape[0],-1)
+        years = chunk[dim].dt.year.values
+        starts = np.flatnonzero(np.r_[True,years[1:] != years[:-1]])
+        stats_chunk = [np.fmax.reduceat(values,starts,axis=0),
+                       np.add.reduceat(~np.isnan(values),starts,axis=0)]
+        if threshold is not None:
+            stats_chunk.append(np.add.reduceat(values > threshold,starts,axis=0))
+        for i, year in enumerate(years[starts]):
+            new = [stat[i] for stat in stats_chunk]
+            if year in blocks:
+                old = blocks[year]
+                new = [np.fmax(old[0],new[0])] + [a + b for a,b in zip(old[1:],new[1:])]
+            blocks[year] = new
+    years = np.array(sorted(blocks))
+    names = ['maxima','count','exceedances'][:len(blocks[years[0]])]
+    dims = ['year'] + list(template.dims)
+    out = xr.Dataset(
+        {name: (dims,np.stack([blocks[y][i] for y in years]).reshape((years.size,) + template.shape))
+         for i,name in enumerate(names)},
+        coords=dict(template.coords,year=years))
+    out['maxima'].attrs = template.attrs
+    return out
+
 def plot_return_levels(obj,c='C0',label='',ax=None):
     '''
     Plot fitted data: